@@ -1,154 +1,414 @@
 import os
-import io
 import re
-import csv
-import json
-import urllib.error
-import urllib.request
+import time
+import gzip
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
 import boto3
-from dotenv import load_dotenv
-
-s3_client = boto3.client('s3')  
-
-load_dotenv()
+import urllib3
+from botocore.config import Config
+
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+# Mantém a conexão com o S3 viva entre invocações e adapta as novas tentativas ao throttling
+s3_client = boto3.client(
+    's3',
+    config=Config(
+        tcp_keepalive=True,
+        retries={'mode': 'adaptive', 'max_attempts': 3},
+    ),
+)
+
+# Na Lambda as variáveis já vêm da configuração da função; o .env só é lido localmente
+if not os.getenv('SENTRY_AUTH_TOKEN'):
+    from dotenv import load_dotenv
+    load_dotenv()
 
 SENTRY_ORGANIZATION_ID = os.getenv('SENTRY_ORGANIZATION_ID')
 SENTRY_PROJECT_SLUG = os.getenv('SENTRY_PROJECT_SLUG')
 SENTRY_AUTH_TOKEN = os.getenv('SENTRY_AUTH_TOKEN')
 S3_BUCKET_NAME = os.getenv('S3_BUCKET_NAME')
 
+CSV_HEADERS = (
+    'issue_id', 'event_id', 'project_id', 'event_type', 'title', 'message',
+    'platform', 'culprit', 'created_at', 'collect_id', 'kind_of_material',
+    'type_of_packaging', 'hauler_cnpj', 'receiver_cnpj', 'sentry_url',
+)
+# Mesmo terminador de linha padrão do csv.writer
+CSV_LINE_TERMINATOR = '\r\n'
+CSV_HEADER_LINE = ';'.join(CSV_HEADERS) + CSV_LINE_TERMINATOR
+CSV_SEPARATOR_COUNT = len(CSV_HEADERS) - 1
+# Linhas codificadas de uma vez ao gravar o CSV
+CSV_WRITE_BATCH_SIZE = 256
 
-def clean_quoted_strings(data):
-    """
-    Remove as aspas simples extras de strings dentro de um dicionário ou lista,
-    assumindo que as aspas extras são parte do valor da string.
-    Ex: "'valor'" se torna "valor".
-    """
-    if isinstance(data, dict):
-        # Cria um novo dicionário para evitar problemas de modificação durante a iteração
-        return {k: clean_quoted_strings(v) for k, v in data.items()}
-    elif isinstance(data, list):
-        # Mapeia a função para cada item da lista
-        return [clean_quoted_strings(elem) for elem in data]
-    elif isinstance(data, str):
-        # Verifica se a string começa e termina com aspas simples
-        if len(data) >= 2 and data.startswith("'") and data.endswith("'"):
-            # Remove o primeiro e o último caractere (as aspas)
-            return data[1:-1]
-        return data
-    else:
-        # Retorna outros tipos de dados como estão (int, float, bool, None, etc.)
-        return data
+# Tamanho mínimo de cada parte de um multipart upload no S3, exceto a última
+MULTIPART_PART_SIZE = 5 * 1024 * 1024
 
+# Tentativas seguidas de buscar uma mesma página do Sentry antes de desistir, com
+# espera exponencial (em segundos) entre elas
+MAX_PAGE_ATTEMPTS = 3
+RETRY_BASE_DELAY = 1
+MAX_RETRY_DELAY = 60
 
-def get_collect_info(entries):
-    for entry in entries:
-        threads_data = entry.get('data', {})
-        threads_list = threads_data.get('values', [])
-        for thread in threads_list:
-            stacktrace = thread.get('stacktrace', {}) or {}
-            frames = stacktrace.get('frames', [])
+SENTRY_ISSUES_URL = 'https://musa-tecnologia.sentry.io/issues/'
 
-            for frame in frames:
-                frame_vars = frame.get('vars', {})
-                if 'body' in frame_vars:
-                    return clean_quoted_strings(frame_vars['body'])
-    return {}
+NEXT_LINK_RE = re.compile(r'<([^>]+)>;\s*rel="next"(?:;\s*results="(true|false)")?')
+# Dicionário vazio compartilhado para buscas em campos ausentes; nunca é alterado
+EMPTY = {}
 
 
-def get_all_events():
-    url = f'https://sentry.io/api/0/projects/{SENTRY_ORGANIZATION_ID}/{SENTRY_PROJECT_SLUG}/events/?full=true'
+class DigitsOnlyTable(dict):
+    """
+    Tabela para str.translate que mantém apenas os dígitos 0-9 e remove
+    qualquer outro caractere, inclusive fora do Latin-1 (ex: travessões).
+    """
+
+    def __missing__(self, code_point):
+        # Guarda a remoção para que o próximo acesso ao mesmo caractere não passe por aqui
+        self[code_point] = None
+        return None
+
 
-    headers = {
+NON_DIGITS_TABLE = DigitsOnlyTable({c: c for c in range(ord('0'), ord('9') + 1)})
+
+# Mantém a conexão TLS com o Sentry aberta entre as páginas
+http = urllib3.PoolManager(
+    num_pools=1,
+    maxsize=4,
+    headers={
         'Authorization': f'Bearer {SENTRY_AUTH_TOKEN}',
         'Accept': 'application/json',
-    }
+        'Accept-Encoding': 'gzip',
+    },
+)
 
-    events = []
-    while url and len(events) < 1000:
-        try:
-            req = urllib.request.Request(url, headers=headers, method='GET')
-            with urllib.request.urlopen(req) as response:
-                response_data = response.read().decode('utf-8')
-                for event in json.loads(response_data):
-                    collect_info = get_collect_info(event['entries'])
-                    
-                    try:
-                        created_at = datetime.strptime(event['dateCreated'], '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')
-                    except ValueError:
-                        created_at = datetime.strptime(event['dateCreated'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')
-
-                    events.append({
-                        'issue_id': event['groupID'],
-                        'event_id': event['eventID'],
-                        'project_id': event['projectID'],
-                        'event_type': event['type'],
-                        'title': event['title'],
-                        'message': event['message'],
-                        'platform': event['platform'],
-                        'culprit': event['culprit'],
-                        'created_at': created_at,
-                        'collect_id': collect_info.get('id'),
-                        'kind_of_material': collect_info.get('material'),
-                        'type_of_packaging': collect_info.get('packaging'),
-                        'hauler_cnpj': re.sub(r'[^0-9]', '', collect_info['hauler']['document']) if 'hauler' in collect_info and collect_info['hauler'].get('document') else None,
-                        'receiver_cnpj': re.sub(r'[^0-9]', '', collect_info['receiver']['document']) if 'receiver' in collect_info and collect_info['receiver'].get('document') else None,
-                        'sentry_url': f"https://musa-tecnologia.sentry.io/issues/{event['groupID']}/events/{event['eventID']}/?project={event['projectID']}",
-                    })
-
-                link_header = response.getheader('Link')
-                url = None
-
-                if link_header:
-                    for link_part in link_header.split(', '):
-                        match = re.search(r'<(.*?)>; rel="next"', link_part)
-                        if match:
-                            url = match.group(1) if 'results="true"' in link_header else None
-
-        except urllib.error.HTTPError as e:
-            print(f"Erro HTTP: {e.code} - {e.reason}")
-            print(e.read().decode('utf-8')) # Mostra o corpo do erro para depuração
-        except urllib.error.URLError as e:
-            print(f"Erro de URL: {e.reason}")
-        except Exception as e:
-            print(f"Um erro inesperado ocorreu: {e}")
+# Reaproveitado entre as páginas para reutilizar os buffers internos do simdjson
+json_parser = simdjson.Parser() if simdjson else None
 
-    return events
 
+def strip_quotes(value):
+    """
+    Remove as aspas simples extras de uma string, assumindo que as aspas
+    extras são parte do valor. Ex: "'valor'" se torna "valor".
+    Outros tipos de dados são retornados como estão.
+    """
+    if isinstance(value, str) and len(value) >= 2 and value[0] == "'" == value[-1]:
+        return value[1:-1]
+    return value
 
-def transform_data_to_csv(data):
-    csv_headers = [
-        'issue_id', 'event_id', 'project_id', 'event_type', 'title', 'message',
-        'platform', 'culprit', 'created_at', 'collect_id', 'kind_of_material',
-        'type_of_packaging', 'hauler_cnpj', 'receiver_cnpj', 'sentry_url',
-    ]
 
-    csv_buffer = io.StringIO()
-    writer = csv.DictWriter(csv_buffer, fieldnames=csv_headers, extrasaction='ignore', delimiter=';')
+def get_collect_info(entries):
+    for entry in entries:
+        for thread in (entry.get('data') or EMPTY).get('values') or ():
+            for frame in (thread.get('stacktrace') or EMPTY).get('frames') or ():
+                body = (frame.get('vars') or EMPTY).get('body')
+                if body is not None:
+                    return body
+    return EMPTY
+
+
+def clean_document(party):
+    document = strip_quotes(party.get('document')) if party else None
+    if document:
+        return document.translate(NON_DIGITS_TABLE)
+    return ''
+
+
+def format_created_at(date_created):
+    # '2024-01-02T03:04:05Z' ou '2024-01-02T03:04:05.123456Z' -> '2024-01-02 03:04:05.123456'
+    if date_created[-1:] == 'Z':
+        if len(date_created) == 20:
+            return f'{date_created[:10]} {date_created[11:19]}.000000'
+        fraction = date_created[20:-1]
+        if 22 <= len(date_created) <= 27 and date_created[19] == '.' and fraction.isdigit():
+            return f'{date_created[:10]} {date_created[11:19]}.{fraction:0<6}'
+
+    # Qualquer outro formato passa pelo parser completo, que falha em vez de gerar um valor errado
+    created_at = datetime.fromisoformat(date_created)
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc)
+    return created_at.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def load_events(payload):
+    if json_parser is not None:
+        return json_parser.parse(payload)
+    return json.loads(payload)
+
+
+def parse_event(event):
+    entries = event['entries']
+    if json_parser is not None:
+        # Materializa apenas a subárvore usada por get_collect_info
+        entries = entries.as_list()
+    collect_info = get_collect_info(entries)
+
+    created_at = format_created_at(event['dateCreated'])
+    group_id = event['groupID']
+    event_id = event['eventID']
+    project_id = event['projectID']
+
+    # Mesma ordem de CSV_HEADERS; campos ausentes viram '' (no CSV, igual a None)
+    # para que a linha siga pelo caminho rápido de format_csv_row
+    return (
+        group_id,
+        event_id,
+        project_id,
+        event['type'],
+        event['title'],
+        event['message'],
+        event['platform'],
+        event['culprit'],
+        created_at,
+        strip_quotes(collect_info.get('id', '')),
+        strip_quotes(collect_info.get('material', '')),
+        strip_quotes(collect_info.get('packaging', '')),
+        clean_document(collect_info.get('hauler')),
+        clean_document(collect_info.get('receiver')),
+        SENTRY_ISSUES_URL + group_id + '/events/' + event_id + '/?project=' + project_id,
+    )
+
+
+class SentryHTTPError(Exception):
+    def __init__(self, status, reason, body, retry_after=None):
+        super().__init__(f'{status} - {reason}')
+        self.status = status
+        self.reason = reason
+        self.body = body
+        self.retry_after = retry_after
+
+
+def fetch_page(url):
+    # O urllib3 descompacta o gzip ao ler o corpo da resposta
+    response = http.request('GET', url, decode_content=True)
+    if response.status >= 400:
+        raise SentryHTTPError(response.status, response.reason, response.data, response.headers.get('Retry-After'))
+
+    match = NEXT_LINK_RE.search(response.headers.get('Link') or '')
+    next_url = match.group(1) if match and match.group(2) == 'true' else None
+    return response.data, next_url
+
+
+def get_retry_delay(attempt, retry_after=None):
+    # Usa o Retry-After do Sentry quando vier em segundos; senão, espera exponencial
+    if retry_after:
+        try:
+            return max(0.0, min(float(retry_after), MAX_RETRY_DELAY))
+        except ValueError:
+            pass
+    return min(RETRY_BASE_DELAY * 2 ** (attempt - 1), MAX_RETRY_DELAY)
+
+
+def parse_page(payload):
+    # Erros de leitura descartam só o evento (ou a página, se o JSON for inválido),
+    # sem contar como falha de busca: buscar a mesma página de novo não os corrige
+    try:
+        events = load_events(payload)
+    except ValueError as e:
+        print(f"Página ignorada, JSON inválido: {e}")
+        return
+
+    for event in events:
+        try:
+            row = parse_event(event)
+        except Exception as e:
+            print(f"Evento ignorado por erro de leitura: {e!r}")
+            continue
+        yield row
 
-    writer.writeheader()
-    writer.writerows(data)
 
-    csv_output = csv_buffer.getvalue()
-    csv_buffer.close()
+def get_all_events():
+    url = f'https://sentry.io/api/0/projects/{SENTRY_ORGANIZATION_ID}/{SENTRY_PROJECT_SLUG}/events/?full=true'
+
+    count = 0
+    failures = 0
+    pending = None
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        while url and count < 1000:
+            try:
+                future = pending or executor.submit(fetch_page, url)
+                pending = None
+                payload, next_url = future.result()
+
+            except SentryHTTPError as e:
+                print(f"Erro HTTP: {e.status} - {e.reason}")
+                print(e.body.decode('utf-8')) # Mostra o corpo do erro para depuração
+                # Só rate limit e erros do servidor podem passar numa nova tentativa
+                if e.status != 429 and e.status < 500:
+                    raise
+                failures += 1
+                if failures >= MAX_PAGE_ATTEMPTS:
+                    raise
+                delay = get_retry_delay(failures, e.retry_after)
+            except urllib3.exceptions.HTTPError as e:
+                print(f"Erro de URL: {e}")
+                failures += 1
+                if failures >= MAX_PAGE_ATTEMPTS:
+                    raise
+                delay = get_retry_delay(failures)
+            except Exception as e:
+                print(f"Um erro inesperado ocorreu: {e}")
+                raise
+            else:
+                failures = 0
+
+                # Busca a próxima página em paralelo enquanto a atual é processada
+                url = next_url
+                if url:
+                    pending = executor.submit(fetch_page, url)
+
+                for row in parse_page(payload):
+                    count += 1
+                    yield row
+                continue
+
+            # Espera fora do except para não manter a exceção viva entre as tentativas
+            time.sleep(delay)
+    finally:
+        # Não espera por uma página buscada além do limite de eventos
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def format_csv_field(value):
+    # Mesmas regras de aspas do csv.writer com delimiter=';' (QUOTE_MINIMAL)
+    if value is None:
+        return ''
+    if not isinstance(value, str):
+        value = str(value)
+    if ';' in value or '"' in value or '\n' in value or '\r' in value:
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def format_csv_row(row):
+    # Caminho rápido: junta a linha inteira de uma vez quando todos os campos
+    # são strings e nenhum deles precisa de aspas
+    try:
+        line = ';'.join(row)
+    except TypeError:
+        line = None
+    if line is None or line.count(';') != CSV_SEPARATOR_COUNT or '"' in line or '\n' in line or '\r' in line:
+        line = ';'.join(map(format_csv_field, row))
+    return line + CSV_LINE_TERMINATOR
+
+
+class S3MultipartUpload:
+    """
+    Arquivo binário somente de escrita que envia o conteúdo ao S3 em partes
+    de MULTIPART_PART_SIZE bytes, à medida que é escrito. O multipart upload
+    só é aberto quando o conteúdo passa de uma parte; abaixo disso, complete()
+    envia tudo com um único put_object.
+
+    Um upload aberto e interrompido sem abort() (ex: timeout da Lambda) fica
+    cobrado no bucket, que deve ter uma regra de ciclo de vida
+    AbortIncompleteMultipartUpload.
+    """
 
-    return csv_output
+    def __init__(self, bucket, key, **kwargs):
+        self.bucket = bucket
+        self.key = key
+        self.kwargs = kwargs
+        self.upload_id = None
+        self.buffer = bytearray()
+        self.parts = []
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= MULTIPART_PART_SIZE:
+            self.upload_part()
+        return len(data)
+
+    def flush(self):
+        # As partes só são enviadas ao atingir o tamanho mínimo exigido pelo S3
+        pass
+
+    def upload_part(self):
+        if self.upload_id is None:
+            response = s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self.kwargs)
+            self.upload_id = response['UploadId']
+
+        part_number = len(self.parts) + 1
+        response = s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(self.buffer),
+        )
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+        self.buffer.clear()
+
+    def complete(self):
+        if self.upload_id is None:
+            s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), **self.kwargs)
+            self.buffer.clear()
+            return
+
+        # A última parte pode ser menor que o mínimo
+        if self.buffer:
+            self.upload_part()
+        s3_client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts},
+        )
+        self.upload_id = None
+
+    def abort(self):
+        # Nada a abortar se o multipart não chegou a ser aberto ou já foi concluído
+        if self.upload_id is not None:
+            s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+
+
+def transform_data_to_csv(rows, csv_output, gzip_output):
+    # Codifica cada lote de linhas uma única vez e grava o mesmo conteúdo no CSV
+    # puro e na cópia comprimida, sem montar o arquivo inteiro em memória
+    lines = itertools.chain((CSV_HEADER_LINE,), map(format_csv_row, rows))
+    with gzip.GzipFile(fileobj=gzip_output, mode='wb', compresslevel=1) as gzip_file:
+        for batch in itertools.batched(lines, CSV_WRITE_BATCH_SIZE):
+            chunk = ''.join(batch).encode('utf-8')
+            csv_output.write(chunk)
+            gzip_file.write(chunk)
 
 
 def lambda_handler(event, context):
     events = get_all_events()
+    first_event = next(events, None)
 
-    if len(events):
-        csv_output = transform_data_to_csv(events)
-
+    if first_event is not None:
         datetime_str = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')
-        filename = f'{SENTRY_PROJECT_SLUG}_backup/events_{datetime_str}.csv'
-        s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=filename, Body=csv_output)
 
+        # O arquivo publicado continua sendo CSV puro, legível por qualquer cliente;
+        # só o backup é comprimido, com a extensão .gz indicando o formato
         filename = f'{SENTRY_PROJECT_SLUG}/events.csv'
-        s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=filename, Body=csv_output)
+        backup_filename = f'{SENTRY_PROJECT_SLUG}_backup/events_{datetime_str}.csv.gz'
+
+        # Envia os dois arquivos ao S3 enquanto as páginas do Sentry ainda estão sendo lidas
+        uploads = (
+            S3MultipartUpload(S3_BUCKET_NAME, filename, ContentType='text/csv; charset=utf-8'),
+            S3MultipartUpload(S3_BUCKET_NAME, backup_filename, ContentType='application/gzip'),
+        )
+        try:
+            transform_data_to_csv(itertools.chain((first_event,), events), *uploads)
+            for upload in uploads:
+                upload.complete()
+        except Exception:
+            for upload in uploads:
+                upload.abort()
+            raise
 
     return {
         'statusCode': 200,
@@ -0,0 +1,263 @@
+import os
+import io
+import csv
+import gzip
+import json
+import random
+import unittest
+from unittest import mock
+
+# Evita o .env local e dá ao boto3 uma região para criar o cliente na importação
+os.environ.setdefault('SENTRY_AUTH_TOKEN', 'test-token')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('S3_BUCKET_NAME', 'bucket')
+os.environ.setdefault('SENTRY_PROJECT_SLUG', 'project')
+
+from src import main
+
+
+class FakeS3:
+    def __init__(self, fail_on_part=None):
+        self.fail_on_part = fail_on_part
+        self.objects = {}
+        self.open_uploads = {}
+        self.calls = []
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.calls.append('put_object')
+        self.objects[Key] = (bytes(Body), kwargs)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.calls.append('create_multipart_upload')
+        upload_id = f'upload-{len(self.calls)}'
+        self.open_uploads[upload_id] = (kwargs, {})
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.calls.append('upload_part')
+        if self.fail_on_part == PartNumber:
+            raise ConnectionError('falha simulada no upload da parte')
+        self.open_uploads[UploadId][1][PartNumber] = bytes(Body)
+        return {'ETag': f'etag-{PartNumber}'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls.append('complete_multipart_upload')
+        kwargs, parts = self.open_uploads.pop(UploadId)
+        numbers = [part['PartNumber'] for part in MultipartUpload['Parts']]
+        self.objects[Key] = (b''.join(parts[number] for number in numbers), kwargs)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append('abort_multipart_upload')
+        del self.open_uploads[UploadId]
+
+
+def random_rows(count, seed=0):
+    rng = random.Random(seed)
+    values = ['', 'a', 'texto simples', 'com;ponto', 'com "aspas"', 'linha\nnova', 'cr\rlf', 'ação – ü', ' espaço ']
+    choices = values + [None, 0, 42, 1.5, True]
+    return [tuple(rng.choice(choices) for _ in main.CSV_HEADERS) for _ in range(count)]
+
+
+def csv_writer_output(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';')
+    writer.writerow(main.CSV_HEADERS)
+    writer.writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+def sentry_event(event_id, **overrides):
+    event = {
+        'entries': [],
+        'dateCreated': '2024-01-02T03:04:05.123Z',
+        'groupID': '10',
+        'eventID': event_id,
+        'projectID': '20',
+        'type': 'error',
+        'title': 'Erro',
+        'message': 'mensagem',
+        'platform': 'python',
+        'culprit': 'app.views',
+    }
+    event.update(overrides)
+    return {k: v for k, v in event.items() if v is not None}
+
+
+class CsvFormattingTest(unittest.TestCase):
+    def test_rows_match_csv_writer(self):
+        rows = random_rows(2000)
+        for row in rows:
+            expected = csv_writer_output([row]).split(b'\r\n', 1)[1].decode('utf-8')
+            self.assertEqual(main.format_csv_row(row), expected)
+
+    def test_plain_and_gzip_outputs_match_csv_writer(self):
+        rows = random_rows(3000, seed=1)
+        csv_output = io.BytesIO()
+        gzip_output = io.BytesIO()
+
+        main.transform_data_to_csv(rows, csv_output, gzip_output)
+
+        expected = csv_writer_output(rows)
+        self.assertEqual(csv_output.getvalue(), expected)
+        self.assertEqual(gzip.decompress(gzip_output.getvalue()), expected)
+
+
+class S3MultipartUploadTest(unittest.TestCase):
+    def test_small_content_uses_single_put_object(self):
+        s3 = FakeS3()
+        with mock.patch.object(main, 's3_client', s3):
+            upload = main.S3MultipartUpload('bucket', 'key', ContentType='text/csv')
+            upload.write(b'abc')
+            upload.complete()
+
+        self.assertEqual(s3.calls, ['put_object'])
+        self.assertEqual(s3.objects['key'], (b'abc', {'ContentType': 'text/csv'}))
+
+    def test_large_content_switches_to_multipart(self):
+        s3 = FakeS3()
+        data = bytes(random.Random(2).getrandbits(8) for _ in range(2500))
+        with mock.patch.object(main, 's3_client', s3), mock.patch.object(main, 'MULTIPART_PART_SIZE', 1000):
+            upload = main.S3MultipartUpload('bucket', 'key')
+            for start in range(0, len(data), 300):
+                upload.write(data[start:start + 300])
+            upload.complete()
+
+        self.assertEqual(s3.calls[0], 'create_multipart_upload')
+        self.assertEqual(s3.calls[-1], 'complete_multipart_upload')
+        self.assertEqual(s3.calls.count('upload_part'), 3)
+        self.assertEqual(s3.objects['key'][0], data)
+        self.assertEqual(s3.open_uploads, {})
+
+    def test_handler_aborts_uploads_when_a_part_fails(self):
+        s3 = FakeS3(fail_on_part=2)
+        rows = random_rows(2000, seed=3)
+        with (
+            mock.patch.object(main, 's3_client', s3),
+            mock.patch.object(main, 'MULTIPART_PART_SIZE', 1000),
+            mock.patch.object(main, 'get_all_events', return_value=iter(rows)),
+        ):
+            with self.assertRaises(ConnectionError):
+                main.lambda_handler({}, {})
+
+        self.assertIn('abort_multipart_upload', s3.calls)
+        self.assertEqual(s3.open_uploads, {})
+        self.assertEqual(s3.objects, {})
+
+    def test_handler_uploads_plain_csv_and_gzip_backup(self):
+        s3 = FakeS3()
+        rows = random_rows(500, seed=4)
+        with (
+            mock.patch.object(main, 's3_client', s3),
+            mock.patch.object(main, 'get_all_events', return_value=iter(rows)),
+        ):
+            main.lambda_handler({}, {})
+
+        self.assertEqual(s3.calls, ['put_object', 'put_object'])
+        expected = csv_writer_output(rows)
+        (backup_key,) = [key for key in s3.objects if key.endswith('.csv.gz')]
+        self.assertEqual(s3.objects[f'{main.SENTRY_PROJECT_SLUG}/events.csv'][0], expected)
+        self.assertEqual(gzip.decompress(s3.objects[backup_key][0]), expected)
+
+
+class GetAllEventsTest(unittest.TestCase):
+    def setUp(self):
+        sleep_patcher = mock.patch.object(main.time, 'sleep')
+        self.sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    def fetch_pages(self, pages):
+        # pages: lista de (payload ou exceção, há próxima página)
+        calls = []
+
+        def fetch_page(url):
+            calls.append(url)
+            result, has_next = pages[len(calls) - 1]
+            if isinstance(result, Exception):
+                raise result
+            return result, f'page-{len(calls)}' if has_next else None
+
+        patcher = mock.patch.object(main, 'fetch_page', side_effect=fetch_page)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return calls
+
+    def event_ids(self):
+        return [row[1] for row in main.get_all_events()]
+
+    def test_bad_event_is_skipped_without_dropping_the_page(self):
+        self.fetch_pages([
+            (json.dumps([sentry_event('e0'), sentry_event('e1', title=None), sentry_event('e2')]).encode(), True),
+            (json.dumps([sentry_event('e3'), sentry_event('e4')]).encode(), False),
+        ])
+
+        self.assertEqual(self.event_ids(), ['e0', 'e2', 'e3', 'e4'])
+
+    def test_invalid_json_page_is_skipped(self):
+        calls = self.fetch_pages([
+            (b'{invalido', True),
+            (json.dumps([sentry_event('e0')]).encode(), False),
+        ])
+
+        self.assertEqual(self.event_ids(), ['e0'])
+        self.assertEqual(len(calls), 2)
+
+    def test_rate_limit_is_retried_with_backoff_then_raised(self):
+        error = main.SentryHTTPError(429, 'Too Many Requests', b'')
+        calls = self.fetch_pages([(error, False)] * main.MAX_PAGE_ATTEMPTS)
+
+        with self.assertRaises(main.SentryHTTPError):
+            self.event_ids()
+
+        self.assertEqual(len(calls), main.MAX_PAGE_ATTEMPTS)
+        self.assertEqual(set(calls), {calls[0]})
+        self.assertEqual([c.args[0] for c in self.sleep.call_args_list], [1, 2])
+
+    def test_retry_after_header_sets_the_delay(self):
+        self.fetch_pages([
+            (main.SentryHTTPError(429, 'Too Many Requests', b'', '7'), False),
+            (json.dumps([sentry_event('e0')]).encode(), False),
+        ])
+
+        self.assertEqual(self.event_ids(), ['e0'])
+        self.sleep.assert_called_once_with(7.0)
+
+    def test_server_error_recovers_on_retry(self):
+        self.fetch_pages([
+            (main.SentryHTTPError(503, 'Service Unavailable', b''), False),
+            (json.dumps([sentry_event('e0')]).encode(), False),
+        ])
+
+        self.assertEqual(self.event_ids(), ['e0'])
+
+    def test_client_error_is_not_retried(self):
+        calls = self.fetch_pages([(main.SentryHTTPError(404, 'Not Found', b''), False)])
+
+        with self.assertRaises(main.SentryHTTPError):
+            self.event_ids()
+
+        self.assertEqual(len(calls), 1)
+        self.sleep.assert_not_called()
+
+
+class FormattingHelpersTest(unittest.TestCase):
+    def test_format_created_at(self):
+        cases = {
+            '2024-01-02T03:04:05Z': '2024-01-02 03:04:05.000000',
+            '2024-01-02T03:04:05.1Z': '2024-01-02 03:04:05.100000',
+            '2024-01-02T03:04:05.123456Z': '2024-01-02 03:04:05.123456',
+            '2024-01-02T01:04:05.123-02:00': '2024-01-02 03:04:05.123000',
+        }
+        for date_created, expected in cases.items():
+            self.assertEqual(main.format_created_at(date_created), expected)
+
+        with self.assertRaises(ValueError):
+            main.format_created_at('02/01/2024 03:04')
+
+    def test_clean_document_keeps_only_ascii_digits(self):
+        for document in ['12.345.678/0001-90', '12.345.678/0001–90', "'12‑345 678/0001-90'"]:
+            self.assertEqual(main.clean_document({'document': document}), '12345678000190')
+        self.assertEqual(main.clean_document(None), '')
+
+
+if __name__ == '__main__':
+    unittest.main()